@@ -1,10 +1,12 @@
 import asyncio
-import json
-from typing import AsyncGenerator, Coroutine, Dict
+import time
+from datetime import datetime, timezone
+from typing import AsyncGenerator, Callable, Coroutine, Dict, Tuple
 import httpx
 from loguru import logger
 from lnbits.settings import settings
-from lnbits.utils.exchange_rates import fiat_amount_as_satoshis, satoshis_amount_as_fiat
+from lnbits.utils.cache import cache
+from lnbits.utils.exchange_rates import get_fiat_rate_satoshis
 from lnbits.wallets.base import InvoiceResponse, PaymentResponse, PaymentStatus, StatusResponse
 from .base import PaymentPendingStatus, Wallet
 
@@ -32,7 +34,25 @@ class StrikeWallet(Wallet):
             "User-Agent": settings.user_agent,
         }
         self.client = httpx.AsyncClient(
-            base_url=f"{self.endpoint}/v1", headers=self.auth)
+            base_url=f"{self.endpoint}/v1",
+            headers=self.auth,
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=64,
+                keepalive_expiry=60.0,
+            ),
+            timeout=httpx.Timeout(40.0, connect=5.0),
+        )
+        self._rate_lock = asyncio.Lock()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # checking_id -> (creation time, expiry time) of invoices still
+        # waiting to be paid
+        self.pending_invoices: Dict[str, Tuple[float, float]] = {}
+        self.invoice_poll_interval = 5
+        # lifetime of invoices whose quote expiry is not known
+        self.pending_invoice_expiry = 60 * 60
+        # margin for clock drift between lnbits and strike
+        self.clock_drift = 60
 
     @property
     def _current_currency(self):
@@ -50,19 +70,15 @@ class StrikeWallet(Wallet):
 
     async def status(self) -> StatusResponse:
         try:
-            r = await self.client.get("/balances", timeout=8)
+            r = await self.client.get(
+                "/balances", timeout=httpx.Timeout(8.0, connect=5.0)
+            )
             r.raise_for_status()
 
             data: list = r.json()
 
-            btc_balance = next(
-                (
-                    wallet["total"]
-                    for wallet in data
-                    if wallet["currency"] == self._current_currency
-                ),
-                None,
-            )
+            balances = {wallet["currency"]: wallet["total"] for wallet in data}
+            btc_balance = balances.get(self._current_currency)
             if btc_balance is None:
                 return StatusResponse("No BTC balance", 0)
 
@@ -70,25 +86,22 @@ class StrikeWallet(Wallet):
 
             return StatusResponse(None, btc_balance*1000)
         except httpx.HTTPStatusError as err:
-            logger.warning(f"HTTP Exception for {err.request.url} - {err.response.json()}")
-            return InvoiceResponse(False, None, None, self.get_error_message(err))
+            return StatusResponse(self._http_error_message(err), 0)
         except Exception as exc:
             logger.warning(exc)
-            return InvoiceResponse(
-                False, None, None, f"Unable to connect to {self.endpoint}."
-            )
+            return StatusResponse(f"Unable to connect to {self.endpoint}.", 0)
 
     async def create_invoice(self, amount: int, memo: str | None = None, description_hash: bytes | None = None, unhashed_description: bytes | None = None, **kwargs) -> InvoiceResponse:
         payload: Dict = {
             "description": memo,
             "amount": {
                 "currency": self._current_currency,
-                "amount": amount / 100_000_000 if self._current_currency == 'BTC' else await satoshis_amount_as_fiat(amount, self._rate_currency)
+                "amount": amount / 100_000_000 if self._current_currency == 'BTC' else amount / await self._get_sats_per_unit()
             }
         }
 
         try:
-            r = await self.client.post("/invoices", json=payload, timeout=40)
+            r = await self.client.post("/invoices", json=payload)
             r.raise_for_status()
 
             checking_id = r.json()['invoiceId']
@@ -97,15 +110,18 @@ class StrikeWallet(Wallet):
             if description_hash:
                 payload2["description_hash"] = description_hash.hex()
 
-            r1 = await self.client.post(f"/invoices/{checking_id}/quote", json=payload2, timeout=40)
+            r1 = await self.client.post(f"/invoices/{checking_id}/quote", json=payload2)
             r1.raise_for_status()
 
-            payment_request = r1.json()["lnInvoice"]
+            quote = r1.json()
+            payment_request = quote["lnInvoice"]
+            created_at = time.time()
+            expiry = quote.get("expirationInSec") or self.pending_invoice_expiry
+            self.pending_invoices[checking_id] = (created_at, created_at + expiry)
             return InvoiceResponse(True, checking_id, payment_request, None)
 
         except httpx.HTTPStatusError as err:
-            logger.warning(f"HTTP Exception for {err.request.url} - {err.response.json()}")
-            return InvoiceResponse(False, None, None, self.get_error_message(err))
+            return InvoiceResponse(False, None, None, self._http_error_message(err))
         except Exception as exc:
             logger.warning(exc)
             return InvoiceResponse(
@@ -117,9 +133,20 @@ class StrikeWallet(Wallet):
             payload: Dict = {"lnInvoice": bolt11,
                              "sourceCurrency": self._current_currency}
 
-            r = await self.client.post("/payment-quotes/lightning", json=payload, timeout=40)
+            r = await self.client.post("/payment-quotes/lightning", json=payload)
             r.raise_for_status()
+        except httpx.HTTPStatusError as err:
+            # no quote, so nothing was paid
+            return PaymentResponse(
+                False, None, None, None, self._http_error_message(err)
+            )
+        except Exception as exc:
+            logger.warning(exc)
+            return PaymentResponse(
+                None, None, None, None, f"Unable to connect to {self.endpoint}."
+            )
 
+        try:
             r1 = await self.client.patch(f"/payment-quotes/{r.json()['paymentQuoteId']}/execute")
             r1.raise_for_status()
             payment = r1.json()
@@ -130,15 +157,48 @@ class StrikeWallet(Wallet):
             return PaymentResponse(True, checking_id, fee_msat, None, None)
 
         except httpx.HTTPStatusError as err:
-            logger.warning(f"HTTP Exception for {err.request.url} - {err.response.json()}")
-            return InvoiceResponse(False, None, None, self.get_error_message(err))
+            # a rejected execute request did not pay, a server error might have
+            ok = False if err.response.is_client_error else None
+            return PaymentResponse(
+                ok, None, None, None, self._http_error_message(err)
+            )
         except Exception as exc:
             logger.warning(exc)
-            return InvoiceResponse(
-                False, None, None, f"Unable to connect to {self.endpoint}."
+            return PaymentResponse(
+                None, None, None, None, f"Unable to connect to {self.endpoint}."
             )
 
     async def get_invoice_status(self, checking_id: str) -> PaymentStatus:
+        return await self._coalesce(
+            f"invoice-{checking_id}",
+            lambda: self._fetch_invoice_status(checking_id),
+        )
+
+    async def get_payment_status(self, checking_id: str) -> PaymentStatus:
+        return await self._coalesce(
+            f"payment-{checking_id}",
+            lambda: self._fetch_payment_status(checking_id),
+        )
+
+    async def _coalesce(
+        self, key: str, fetch: Callable[[], Coroutine]
+    ) -> PaymentStatus:
+        # concurrent status checks for the same id share one upstream request
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_inflight_done(key, t))
+        # shield, so a cancelled caller does not cancel the other waiters
+        return await asyncio.shield(task)
+
+    def _on_inflight_done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        # retrieve the exception, the waiters may all have been cancelled
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error getting status for {key}: {task.exception()}")
+
+    async def _fetch_invoice_status(self, checking_id: str) -> PaymentStatus:
         statuses = {
             "UNPAID": None,
             "PENDING": None,
@@ -159,7 +219,7 @@ class StrikeWallet(Wallet):
             logger.error(f"Error getting invoice status: {e}")
             return PaymentPendingStatus()
 
-    async def get_payment_status(self, checking_id: str) -> PaymentStatus:
+    async def _fetch_payment_status(self, checking_id: str) -> PaymentStatus:
         statuses = {"PENDING": None, "COMPLETED": True, "FAILED": False}
 
         try:
@@ -170,18 +230,107 @@ class StrikeWallet(Wallet):
 
             data = r.json()
 
-            return PaymentStatus(statuses[data.state])
-        except Exception as e:
+            return PaymentStatus(statuses[data["state"]])
+        except (KeyError, ValueError, httpx.HTTPError) as e:
             logger.error(f"Error getting payment status: {e}")
             return PaymentStatus(None)
 
     async def paid_invoices_stream(self) -> AsyncGenerator[str, None]:
-        self.queue: asyncio.Queue = asyncio.Queue(0)
+        # Strike does not push invoice updates, so all pending invoices are
+        # checked together with one paged list request per interval.
+        # Invoices created before a restart are picked up from Strike's list
+        # of unpaid invoices, if that first request fails they are not tracked.
+        await self._load_pending_invoices()
+
         while settings.lnbits_running:
-            value = await self.queue.get()
-            yield value
+            await asyncio.sleep(self.invoice_poll_interval)
+            if not self.pending_invoices:
+                continue
+
+            created_after = (
+                min(c for c, _ in self.pending_invoices.values()) - self.clock_drift
+            )
+            for invoice in await self._get_invoices("PAID", created_after):
+                # skip malformed items instead of restarting the listener
+                if not isinstance(invoice, dict) or not invoice.get("invoiceId"):
+                    continue
+                checking_id = invoice["invoiceId"]
+                if self.pending_invoices.pop(checking_id, None) is not None:
+                    yield checking_id
+
+            # invoices paid just before they expire may be listed late
+            expired_before = time.time() - self.clock_drift
+            for checking_id, (_, expires_at) in list(self.pending_invoices.items()):
+                if expires_at < expired_before:
+                    self.pending_invoices.pop(checking_id)
+
+    async def _load_pending_invoices(self):
+        created_after = time.time() - self.pending_invoice_expiry
+        try:
+            for invoice in await self._get_invoices("UNPAID", created_after):
+                created_at = self._parse_created(invoice["created"])
+                self.pending_invoices.setdefault(
+                    invoice["invoiceId"],
+                    (created_at, created_at + self.pending_invoice_expiry),
+                )
+        except (KeyError, TypeError, ValueError) as e:
+            logger.error(f"Error loading unpaid invoices: {e}")
+
+    async def _get_invoices(self, state: str, created_after: float) -> list:
+        created = datetime.fromtimestamp(int(created_after), timezone.utc)
+        query = f"state eq '{state}' and created ge {created:%Y-%m-%dT%H:%M:%SZ}"
+        invoices: list = []
+        try:
+            # oldest first, so invoices created while paging are only appended
+            while True:
+                params = {
+                    "$filter": query,
+                    "$orderby": "created asc",
+                    "$skip": len(invoices),
+                    "$top": 100,
+                }
+                r = await self.client.get("/invoices", params=params)
+                r.raise_for_status()
+                data = r.json()
+                invoices += data["items"]
+                if not data["items"] or len(invoices) >= data["count"]:
+                    return invoices
+        except (KeyError, TypeError, ValueError, httpx.HTTPError) as e:
+            logger.error(f"Error getting {state.lower()} invoices: {e}")
+            return []
+
+    @staticmethod
+    def _parse_created(created: str) -> float:
+        # Strike timestamps are UTC, the fraction and offset are not needed
+        return (
+            datetime.strptime(created[:19], "%Y-%m-%dT%H:%M:%S")
+            .replace(tzinfo=timezone.utc)
+            .timestamp()
+        )
+
+    def _http_error_message(self, err: httpx.HTTPStatusError) -> str:
+        logger.warning(f"HTTP Exception for {err.request.url} - {err.response.text}")
+        try:
+            return self.get_error_message(err)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            # not an error from the strike api, e.g. a proxy error page, which
+            # is only logged above
+            status_code = err.response.status_code
+            return f"HTTP {status_code} {httpx.codes.get_reason_phrase(status_code)}"
 
     async def _get_btc_amount(self, amount: float):
         if self._rate_currency == "BTC":
             return int(amount * 100_000_000)
-        return await fiat_amount_as_satoshis(amount, currency=self._rate_currency)
+        return int(amount * await self._get_sats_per_unit())
+
+    async def _get_sats_per_unit(self) -> float:
+        key = f"strike-rate-{self._rate_currency}"
+        rate = cache.get(key)
+        if rate:
+            return rate
+        # the lock makes concurrent callers wait for a single rate refresh,
+        # get_fiat_rate_satoshis has its own 10s cache of the btc price
+        async with self._rate_lock:
+            return await cache.save_result(
+                lambda: get_fiat_rate_satoshis(self._rate_currency), key, expiry=10
+            )
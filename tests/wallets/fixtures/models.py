@@ -78,11 +78,18 @@ class WalletTest(BaseModel):
         fn,
         test,
     ) -> List["WalletTest"]:
+        expect = test.get("expect")
+        fs_expect = test.get("funding_source_expect", {})
+        if expect and fs.name in fs_expect:
+            # a funding source can expect a different outcome for the same test
+            expect = expect | fs_expect[fs.name]
+
         t = WalletTest(
             **{
                 "funding_source": fs,
                 "function": fn_name,
                 **test,
+                "expect": expect,
                 "mocks": [],
                 "skip": fs.skip,
             }
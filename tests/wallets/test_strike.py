@@ -0,0 +1,150 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from pytest_mock.plugin import MockerFixture
+
+from lnbits.settings import settings
+from lnbits.utils.cache import cache
+from lnbits.wallets import StrikeWallet
+from lnbits.wallets.base import StatusResponse
+
+
+@pytest.fixture()
+def strike_wallet(monkeypatch: pytest.MonkeyPatch) -> StrikeWallet:
+    monkeypatch.setattr(settings, "strike_api_endpoint", "http://127.0.0.1:8555")
+    monkeypatch.setattr(settings, "strike_token", "mock-strike-token")
+    monkeypatch.setattr(settings, "strike_currency", "BTC")
+    return StrikeWallet()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_invoice_status_single_request(
+    strike_wallet: StrikeWallet, mocker: MockerFixture
+):
+    async def get(url, **_):
+        await asyncio.sleep(0.01)
+        return httpx.Response(200, json={"state": "PAID"})
+
+    mock_get = mocker.patch.object(strike_wallet.client, "get", side_effect=get)
+
+    statuses = await asyncio.gather(
+        *[strike_wallet.get_invoice_status("invoice-id") for _ in range(5)]
+    )
+
+    assert all(status.success for status in statuses)
+    mock_get.assert_called_once_with("/invoices/invoice-id")
+    assert strike_wallet._inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_paid_invoices_stream_yields_pending_invoices(
+    strike_wallet: StrikeWallet, mocker: MockerFixture
+):
+    invoices = {
+        "UNPAID": [{"invoiceId": "unpaid-id", "created": "2024-08-01T10:00:00Z"}],
+        "PAID": [
+            {"invoiceId": "pending-id", "created": "2024-08-01T10:00:00Z"},
+            {"invoiceId": "unknown-id", "created": "2024-08-01T10:00:00Z"},
+        ],
+    }
+
+    async def get(url, params):
+        state = "PAID" if "'PAID'" in params["$filter"] else "UNPAID"
+        skip = params["$skip"]
+        # one invoice per page to go through the paging
+        items = invoices[state][skip : skip + 1]
+        data = {"items": items, "count": len(invoices[state])}
+        return httpx.Response(200, json=data, request=httpx.Request("GET", url))
+
+    mock_get = mocker.patch.object(strike_wallet.client, "get", side_effect=get)
+    strike_wallet.invoice_poll_interval = 0
+    now = time.time()
+    strike_wallet.pending_invoices["pending-id"] = (now, now + 60)
+
+    stream = strike_wallet.paid_invoices_stream()
+    assert await stream.__anext__() == "pending-id"
+    await stream.aclose()
+
+    assert list(strike_wallet.pending_invoices) == ["unpaid-id"]
+    created_at, expires_at = strike_wallet.pending_invoices["unpaid-id"]
+    assert expires_at - created_at == strike_wallet.pending_invoice_expiry
+    # 1 page of unpaid invoices, 2 pages of paid invoices
+    assert mock_get.call_count == 3
+    paid_filter = mock_get.call_args.kwargs["params"]["$filter"]
+    assert paid_filter.startswith("state eq 'PAID' and created ge ")
+
+
+@pytest.mark.asyncio
+async def test_paid_invoices_stream_yields_invoice_listed_after_expiry(
+    strike_wallet: StrikeWallet, mocker: MockerFixture
+):
+    polls = []
+
+    async def get(url, params):
+        items = []
+        if "'PAID'" in params["$filter"]:
+            polls.append(params)
+            # the invoice is only listed as paid on the second poll,
+            # next to items that are not invoices
+            if len(polls) > 1:
+                items = [None, {}, {"invoiceId": "late-id"}]
+        data = {"items": items, "count": len(items)}
+        return httpx.Response(200, json=data, request=httpx.Request("GET", url))
+
+    mocker.patch.object(strike_wallet.client, "get", side_effect=get)
+    strike_wallet.invoice_poll_interval = 0
+    now = time.time()
+    # paid just before the quote expired
+    strike_wallet.pending_invoices["late-id"] = (now - 100, now - 1)
+
+    stream = strike_wallet.paid_invoices_stream()
+    assert await asyncio.wait_for(stream.__anext__(), timeout=1) == "late-id"
+    await stream.aclose()
+
+    assert len(polls) == 2
+    assert strike_wallet.pending_invoices == {}
+
+
+@pytest.mark.asyncio
+async def test_fiat_rate_fetched_once_per_ttl(
+    strike_wallet: StrikeWallet,
+    mocker: MockerFixture,
+    monkeypatch: pytest.MonkeyPatch,
+):
+    async def get_rate(currency):
+        await asyncio.sleep(0.01)
+        return 1000.0
+
+    mock_rate = mocker.patch(
+        "lnbits.wallets.strike.get_fiat_rate_satoshis", side_effect=get_rate
+    )
+    monkeypatch.setattr(settings, "strike_currency", "USD")
+    cache.pop("strike-rate-USD")
+
+    rates = await asyncio.gather(
+        *[strike_wallet._get_sats_per_unit() for _ in range(5)]
+    )
+    assert rates == [1000.0] * 5
+    assert await strike_wallet._get_btc_amount(2.5) == 2500
+    mock_rate.assert_called_once_with("USD")
+
+    # an expired rate is fetched again
+    cache.pop("strike-rate-USD")
+    await strike_wallet._get_sats_per_unit()
+    assert mock_rate.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_status_connection_error(
+    strike_wallet: StrikeWallet, mocker: MockerFixture
+):
+    mocker.patch.object(
+        strike_wallet.client, "get", side_effect=httpx.ConnectError("refused")
+    )
+
+    status = await strike_wallet.status()
+
+    assert isinstance(status, StatusResponse)
+    assert status == StatusResponse("Unable to connect to http://127.0.0.1:8555.", 0)